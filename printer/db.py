@@ -1,120 +1,352 @@
 import sqlite3
 import logging
-from datetime import datetime
+import threading
+import queue
+import time
+from concurrent.futures import Future
+from typing import Optional
 # Message model now includes ip_address field
 from printer.model import Message
 
+class DuplicateMessage(Exception):
+    """
+    Set on an insert's Future when a message with the same uid is already
+    stored, e.g. a QoS 1 redelivery from the MQTT broker.
+    """
+
 class DB:
     """
     Handles database operations for the printer application using SQLite.
-    Assumes the table is created from scratch on initialization.
+    Creates the tables on initialization, or migrates an older database by
+    adding the missing ip_address and uid columns; images such databases
+    stored inline stay in the legacy messages.img column.
+
+    Writes are queued to a single background writer thread (SQLite only
+    allows one active writer), which commits whatever is pending as one
+    transaction. Reads use a lazily opened connection per thread, so they run
+    concurrently with writes under WAL.
     """
 
-    def __init__(self, db_path: str = "printer_messages.db"):
+    # SQL is kept as constants so every call passes the same string and hits
+    # sqlite3's per-connection statement cache instead of re-preparing.
+    # OR IGNORE turns a repeated uid into a no-op, see DuplicateMessage
+    INSERT_SQL = "INSERT OR IGNORE INTO messages (uid, title, msg, ip_address) VALUES (?, ?, ?, ?)"
+    INSERT_IMAGE_SQL = "INSERT INTO message_images (id, img) VALUES (?, ?)"
+    COUNT_SQL = "SELECT COUNT(*) FROM messages"
+
+    # A batch is committed once it has BATCH_SIZE rows or BATCH_WINDOW seconds
+    # have passed since its first row was queued, whichever comes first
+    BATCH_SIZE = 50
+    BATCH_WINDOW = 0.2
+
+    # Seconds a count() result is served from memory before re-running COUNT(*)
+    COUNT_TTL = 1.0
+
+    PRAGMAS = """
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;
+        PRAGMA busy_timeout=3000;
+    """
+
+    def __init__(self, db_path: str = "printer_messages.db", debug: bool = False):
         """
-        Initializes the database connection, sets journal mode to WAL,
-        and creates the messages table.
+        Initializes the writer connection, sets journal mode to WAL,
+        applies the PRAGMA tuning and creates the tables.
 
         Args:
             db_path: The path to the SQLite database file.
+            debug: If True, every SQL statement executed is logged at DEBUG level.
         """
+        self.db_path = db_path
+        self.debug = debug
+        self.conn = None
+        self._write_q = queue.Queue()
+        self._writer = None
+        self._local = threading.local()
+        self._readers = [] # All per-thread read connections, so close() can reach them
+        self._readers_lock = threading.Lock()
+        self._count_cache = (0.0, None) # (time.monotonic() of the query, count)
+        self._count_lock = threading.Lock()
         try:
-            self.db_path = db_path
-            self.conn = sqlite3.connect(db_path, check_same_thread=False) # Allow access from different threads if needed
-            self.cursor = self.conn.cursor()
+            # Opened here for setup, then used only by the writer thread
+            self.conn = self._connect(check_same_thread=False)
+
+            # Larger pages for new databases; only takes effect before the file is
+            # initialized, which switching to WAL below already does
+            self.conn.execute("PRAGMA page_size=8192;")
 
             # Set journal mode to WAL
-            self.cursor.execute("PRAGMA journal_mode=WAL;")
-            current_journal_mode = self.cursor.fetchone()
+            current_journal_mode = self.conn.execute("PRAGMA journal_mode=WAL;").fetchone()
             logging.info(f"SQLite journal mode set to: {current_journal_mode[0] if current_journal_mode else 'Unknown'}")
             if current_journal_mode and current_journal_mode[0].lower() != 'wal':
                  logging.warning(f"Failed to set journal_mode to WAL. Current mode: {current_journal_mode[0]}")
 
+            for pragma in ("page_size", "synchronous", "temp_store", "mmap_size", "cache_size", "busy_timeout"):
+                value = self.conn.execute(f"PRAGMA {pragma};").fetchone()
+                logging.info(f"SQLite {pragma} set to: {value[0] if value else 'Unknown'}")
 
             self._create_table()
+
+            self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+            self._writer.start()
             logging.info(f"Database initialized successfully at {db_path}")
         except sqlite3.Error as e:
             logging.error(f"Database error during initialization: {e}", exc_info=True)
             if self.conn: # Attempt to close connection if it was opened before error
                 self.conn.close()
+                self.conn = None
             raise  # Re-raise the exception after logging
 
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        """
+        Opens a new connection to the database with the PRAGMA tuning applied.
+        """
+        conn = sqlite3.connect(self.db_path, check_same_thread=check_same_thread, cached_statements=256)
+        if self.debug:
+            conn.set_trace_callback(logging.debug)
+        self._apply_pragmas(conn)
+        return conn
+
+    def _apply_pragmas(self, conn: sqlite3.Connection):
+        """
+        Applies the WAL-friendly PRAGMA set. With WAL, synchronous=NORMAL only
+        fsyncs on checkpoint instead of on every commit.
+        Failures are logged and the connection keeps SQLite's defaults.
+        """
+        try:
+            conn.executescript(self.PRAGMAS)
+        except sqlite3.Error as e:
+            logging.warning(f"Failed to apply SQLite PRAGMA tuning, using defaults: {e}")
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """
+        Returns the read connection for the calling thread, opening it on first use.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Only the owning thread uses it; check_same_thread is off so close() can reach it
+            conn = self._connect(check_same_thread=False)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
     def _create_table(self):
         """
-        Creates the 'messages' table if it doesn't already exist.
-        Includes the ip_address column. Assumes no pre-existing table needs altering.
+        Creates the 'messages' and 'message_images' tables if they don't already exist.
+        Includes the ip_address column, which is added to 'messages' tables
+        created before it existed.
+
+        Images are kept out of 'messages' so its rows stay small: a 256x256 PNG
+        would otherwise spill into overflow pages that COUNT(*) and any scan of
+        the table have to walk. Images stored inline by older versions stay in
+        the legacy messages.img column.
+
+        The id is a plain INTEGER PRIMARY KEY (the rowid) without AUTOINCREMENT,
+        which saves the sqlite_sequence update on every insert. The only
+        difference is that the id of the newest row can be reused if that row is
+        deleted, which never happens here. Existing tables keep their schema.
         """
         try:
             # Create table with ip_address column if it doesn't exist
-            self.cursor.execute("""
+            self.conn.execute("""
                 CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id INTEGER PRIMARY KEY,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                     title TEXT,
-                    img BLOB,
                     msg TEXT,
-                    ip_address TEXT
+                    ip_address TEXT,
+                    uid TEXT
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS message_images (
+                    id INTEGER PRIMARY KEY REFERENCES messages(id),
+                    img BLOB
                 )
             """)
+            # Older databases predate the ip_address and uid columns
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(messages);")}
+            for column in ("ip_address", "uid"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE messages ADD COLUMN {column} TEXT")
+                    logging.info(f"Added missing '{column}' column to table 'messages'.")
+            # Rows from before the uid column have NULL there, which UNIQUE allows
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_uid ON messages (uid)")
             self.conn.commit() # Commit the table creation
-            logging.info("Table 'messages' checked/created successfully.")
+            logging.info("Tables 'messages' and 'message_images' checked/created successfully.")
         except sqlite3.Error as e:
             logging.error(f"Database error creating table: {e}", exc_info=True)
             raise
 
-    def insert(self, message: Message):
+    def _writer_loop(self):
+        """
+        Drains the write queue, committing up to BATCH_SIZE rows collected within
+        BATCH_WINDOW in one transaction, so the commit cost is paid per batch
+        instead of per message. A None item flushes the current batch and stops the loop.
+        """
+        running = True
+        while running:
+            batch = []
+            item = self._write_q.get()
+            deadline = time.monotonic() + self.BATCH_WINDOW
+            while item is not None:
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.BATCH_SIZE or remaining <= 0:
+                    break
+                try:
+                    item = self._write_q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            else:
+                running = False
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch: list[tuple[Message, Future]]):
+        """
+        Inserts a batch of queued messages in a single transaction and resolves
+        each future with its row ID, None if its insert failed, or
+        DuplicateMessage if the uid was already stored.
+
+        Each row is written under its own SAVEPOINT, so a bad row is rolled back
+        alone and the rest of the batch still commits. Every future is resolved
+        whatever happens, as insert() blocks on it.
+        """
+        ids = []
+        try:
+            self.conn.execute("BEGIN")
+            for message, _ in batch:
+                ids.append(self._insert_row(message))
+            self.conn.commit()
+        except Exception as e:
+            logging.error(f"Database error inserting batch of {len(batch)} message(s): {e}", exc_info=True)
+            try:
+                self.conn.rollback() # Rollback on error
+            except sqlite3.Error as rollback_error:
+                logging.error(f"Failed to roll back batch: {rollback_error}")
+            ids = [None] * len(batch)
+        else:
+            # Bump a cached count in place so pollers in this process see new rows immediately
+            inserted = sum(isinstance(last_id, int) for last_id in ids)
+            with self._count_lock:
+                ts, val = self._count_cache
+                if val is not None:
+                    self._count_cache = (ts, val + inserted)
+
+        for (message, future), last_id in zip(batch, ids):
+            if isinstance(last_id, DuplicateMessage):
+                logging.warning(f"Message {message.uid} already stored, ignoring duplicate.")
+                future.set_exception(last_id)
+                continue
+            if last_id is not None:
+                logging.info(f"Inserted message with ID: {last_id} from IP: {message.ip_address}")
+            future.set_result(last_id)
+
+    def _insert_row(self, message: Message) -> int | DuplicateMessage | None:
         """
-        Inserts a message into the database table, including the IP address.
+        Inserts one message inside the current batch transaction.
+
+        Returns:
+            The row ID, DuplicateMessage if the uid was already stored, or None
+            if the insert failed and was rolled back to its savepoint.
+        """
+        self.conn.execute("SAVEPOINT row")
+        try:
+            cursor = self.conn.execute(self.INSERT_SQL, (message.uid, message.title, message.msg, message.ip_address))
+            if cursor.rowcount == 0: # Ignored: uid already stored
+                result = DuplicateMessage(message.uid)
+            else:
+                if message.img:
+                    self.conn.execute(self.INSERT_IMAGE_SQL, (cursor.lastrowid, message.img))
+                result = cursor.lastrowid
+        except Exception as e:
+            logging.error(f"Database error inserting message {getattr(message, 'uid', None)}: {e}", exc_info=True)
+            self.conn.execute("ROLLBACK TO row")
+            result = None
+        self.conn.execute("RELEASE row")
+        return result
+
+    def enqueue_insert(self, message: Message) -> Future:
+        """
+        Queues a message for the writer thread without waiting for the commit.
 
         Args:
             message: A Message object containing the data to insert.
 
         Returns:
-            The row ID of the inserted message, or None if insertion fails.
+            A Future resolved with the row ID of the inserted message, or None if insertion fails.
+            It raises DuplicateMessage if a message with the same uid was already stored.
         """
-        # Update SQL query to include ip_address
-        sql = "INSERT INTO messages (title, img, msg, ip_address) VALUES (?, ?, ?, ?)"
-        try:
-            # Ensure img is bytes or None.
-            img_data = message.img if isinstance(message.img, bytes) or message.img is None else None
-            if message.img is not None and not isinstance(message.img, bytes):
-                 logging.warning(f"Image data for insert was not bytes (type: {type(message.img)}), inserting NULL for image.")
+        future = Future()
+        if self._writer is None:
+            logging.error("Database writer is not running, message not saved.")
+            future.set_result(None)
+        else:
+            self._write_q.put((message, future))
+        return future
 
-            # Get ip_address from the message object (defaults to None in model)
-            ip_addr = message.ip_address
+    def insert(self, message: Message) -> Optional[int]:
+        """
+        Inserts a message into the database table, including the IP address,
+        and waits until it is committed.
 
-            # Update parameters tuple to include ip_address
-            self.cursor.execute(sql, (message.title, img_data, message.msg, ip_addr))
-            self.conn.commit()
-            last_id = self.cursor.lastrowid
-            logging.info(f"Inserted message with ID: {last_id} from IP: {ip_addr}")
-            return last_id
-        except sqlite3.Error as e:
-            logging.error(f"Database error inserting message: {e}", exc_info=True)
-            self.conn.rollback() # Rollback on error
-            return None
+        Args:
+            message: A Message object containing the data to insert.
+
+        Returns:
+            The row ID of the inserted message, or None if insertion fails.
+
+        Raises:
+            DuplicateMessage: If a message with the same uid was already stored.
+        """
+        return self.enqueue_insert(message).result()
 
 
     def count(self) -> int:
         """
         Counts the total number of messages in the database.
+        The result is cached for COUNT_TTL seconds, which also bounds how stale
+        it can be when another process (the worker) is inserting.
 
         Returns:
             The total number of messages, or 0 if an error occurs or table is empty.
         """
-        sql = "SELECT COUNT(*) FROM messages"
+        ts, val = self._count_cache
+        if val is not None and time.monotonic() - ts < self.COUNT_TTL:
+            return val
         try:
-            self.cursor.execute(sql)
-            result = self.cursor.fetchone()
-            return result[0] if result else 0
+            result = self._get_conn().execute(self.COUNT_SQL).fetchone()
+            val = result[0] if result else 0
+            with self._count_lock:
+                self._count_cache = (time.monotonic(), val)
+            return val
         except sqlite3.Error as e:
             logging.error(f"Database error counting messages: {e}", exc_info=True)
             return 0 # Return 0 on error
 
     def close(self):
         """
-        Closes the database connection.
+        Commits any queued inserts, then closes the writer and all per-thread
+        read connections.
         """
+        if self._writer:
+            self._write_q.put(None)
+            self._writer.join()
+            self._writer = None
+
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+        for reader in readers:
+            try:
+                reader.close()
+            except sqlite3.Error as e:
+                logging.error(f"Error closing read connection: {e}", exc_info=True)
+        self._local = threading.local()
+
         if self.conn:
             try:
                 # Optional: Commit any pending changes before closing, though WAL mode handles this differently.
@@ -131,4 +363,3 @@ class DB:
         Ensure connection is closed when the object is destroyed.
         """
         self.close()
-
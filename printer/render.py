@@ -0,0 +1,41 @@
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from escpos.printer import Dummy
+
+# Printer profile, shared by the server (which renders images) and the worker
+PROFILE = "NT-5890K"  # or "POS-5890" depending on your printer
+
+# Recently rendered images, keyed by a BLAKE2b digest of the PNG bytes.
+# Identical drawings (e.g. the same template) skip the decode and dither.
+RENDER_CACHE_SIZE = 128
+_render_cache: OrderedDict[bytes, bytes] = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+def render_image(img_data: bytes) -> bytes:
+    """
+    Converts PNG bytes into the ESC/POS raster commands printer.image() would
+    send, so the worker can write them to the printer as-is.
+    Results are cached for the last RENDER_CACHE_SIZE distinct images.
+
+    Raises:
+        Any Pillow/escpos error if the image can't be decoded.
+    """
+    key = hashlib.blake2b(img_data, digest_size=16).digest()
+    with _render_cache_lock:
+        raw = _render_cache.get(key)
+        if raw is not None:
+            _render_cache.move_to_end(key)
+            return raw
+
+    printer = Dummy(profile=PROFILE)
+    printer.image(io.BytesIO(img_data), center=True)
+    raw = printer.output
+
+    with _render_cache_lock:
+        _render_cache[key] = raw
+        _render_cache.move_to_end(key)
+        if len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return raw
@@ -1,24 +1,21 @@
-import io
+import asyncio
 import argparse
 import uvicorn
 import logging
-import base64
+import struct
 from pathlib import Path
 from typing import Optional
-# Import Pillow and BytesIO
-from PIL import Image
-from io import BytesIO
-# Remove unused Usb import if not needed elsewhere in the full file
-# from escpos.printer import Usb
+from contextlib import asynccontextmanager
 from printer.model import Message
 import paho.mqtt.client as mqtt
 # Import Request from FastAPI
-from fastapi import FastAPI, HTTPException, Request
-from starlette.responses import FileResponse
-from pydantic import BaseModel, Field # Import Field
+from fastapi import FastAPI, HTTPException, Request, Depends, Form, File, UploadFile
+from starlette.responses import JSONResponse, Response
+from pydantic import BaseModel
 from printer.log import init
 # Import the DB class
 from printer.db import DB
+from printer.render import render_image
 
 # init log config
 init()
@@ -26,16 +23,44 @@ init()
 # --- Expected Image Dimensions ---
 EXPECTED_WIDTH = 256
 EXPECTED_HEIGHT = 256
+# A PNG starts with this signature followed by the IHDR chunk:
+# 4-byte length, b"IHDR", then big-endian width and height at bytes 16..24
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Upper bound for an upload: a 256x256 RGBA PNG is at most ~260 KB even uncompressed
+MAX_IMAGE_BYTES = 300_000
+# Upper bound for a whole request body: the image plus the text fields and multipart framing
+MAX_BODY_BYTES = MAX_IMAGE_BYTES + 16_384
 # ---------------------------------
 
-# --- Initialize Database ---
-try:
-    db = DB() # Default path "printer_messages.db"
-    logging.info("Database connection established for server.")
-except Exception as e:
-    logging.critical(f"Failed to initialize database: {e}", exc_info=True)
-    import sys; sys.exit(1) # Exit if DB connection fails
-# ---------------------------
+# --- Static Assets ---
+# Read once at startup so requests don't reopen the files
+INDEX_HTML = Path("public/index.html").read_bytes()
+PRINTER_PNG = Path("public/printer.png").read_bytes()
+FONT_HP100 = Path("public/WebPlus_HP_100LX_6x8.woff").read_bytes()
+# The image and font never change between deploys, let browsers keep them
+ASSET_HEADERS = {"cache-control": "public, max-age=86400"}
+# ---------------------
+
+# --- Startup Settings ---
+MQTT_BROKER = "127.0.0.1"
+MQTT_PORT = 1883
+STARTUP_ATTEMPTS = 5 # Tries for the DB and MQTT connections before giving up
+STARTUP_RETRY_DELAY = 0.5 # Seconds before the first retry, doubled after each failure
+# ------------------------
+
+def publish(client: mqtt.Client, payload: bytes) -> bool:
+    """
+    Publishes a payload to the 'printer' topic with QoS 1.
+    With loop_start() running, paho only queues the packet here and its network
+    thread does the socket I/O, so this is safe to call from the event loop.
+    Publishes made while disconnected stay in paho's queue and are sent after
+    it reconnects, so there is nothing to retry here.
+    """
+    info = client.publish("printer", payload, qos=1)
+    if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+        logging.error(f"MQTT publish failed: {mqtt.error_string(info.rc)}")
+        return False
+    return True
 
 def on_connect(client, userdata, flags, rc, props):
     if rc == 0:
@@ -44,111 +69,222 @@ def on_connect(client, userdata, flags, rc, props):
         logging.fatal(f"Failed to connect, return code: {rc}")
         import sys; sys.exit(1)
 
-# start MQTT Client
-client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-client.on_connect = on_connect
-client.connect("127.0.0.1", 1883)
-client.loop_start()
+async def with_retry(name: str, func):
+    """
+    Runs a blocking setup call in a thread, retrying with exponential backoff
+    so a transiently locked DB or a broker that is still starting doesn't
+    kill the worker. Re-raises the last error once all attempts fail.
+    """
+    delay = STARTUP_RETRY_DELAY
+    for attempt in range(1, STARTUP_ATTEMPTS + 1):
+        try:
+            return await asyncio.to_thread(func)
+        except Exception as e:
+            if attempt == STARTUP_ATTEMPTS:
+                logging.critical(f"{name} failed after {attempt} attempts: {e}", exc_info=True)
+                raise
+            logging.warning(f"{name} failed (attempt {attempt}/{STARTUP_ATTEMPTS}): {e}. Retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Opens the database and the MQTT client once per server process and
+    closes them on shutdown.
+    """
+    app.state.db = await with_retry("Database connection", DB) # Default path "printer_messages.db"
+    logging.info("Database connection established for server.")
+
+    # start MQTT Client
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    # Keep more QoS 1 publishes in flight so bursts don't wait on each PUBACK
+    client.max_inflight_messages_set(100)
+    try:
+        await with_retry("MQTT connection", lambda: client.connect(MQTT_BROKER, MQTT_PORT))
+    except Exception:
+        app.state.db.close()
+        raise
+    client.loop_start()
+    app.state.mqtt = client
+
+    try:
+        yield
+    finally:
+        logging.info("Shutting down server...")
+        client.loop_stop()
+        client.disconnect()
+        logging.info("MQTT client loop stopped.")
+        app.state.db.close()
+
+class BodySizeLimit:
+    """
+    ASGI middleware rejecting request bodies over max_bytes with a 413.
+    Starlette receives and spools a whole multipart body before the handler
+    runs, so the size has to be enforced here for an oversized upload to stop
+    costing bandwidth and disk at the limit. A too large Content-Length is
+    refused before reading anything; bodies without one are counted as they
+    stream in.
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
 
-app = FastAPI()
+        too_large = HTTPException(status_code=413, detail=f"Request too large. Maximum size is {self.max_bytes} bytes.")
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            logging.warning(f"Rejected request with Content-Length {int(content_length)} over {self.max_bytes} bytes.")
+            response = JSONResponse({"detail": too_large.detail}, status_code=too_large.status_code)
+            return await response(scope, receive, send)
 
-# Pydantic model for the print request body with validation
-class PrintRequest(BaseModel):
-    # Allow None, but if present, limit length. Default to None if empty string is sent.
-    title: Optional[str] = Field(default=None, max_length=40)
-    # Image data URL is optional
-    img: Optional[str]
-    # Message is required (can be empty string), limit length
-    msg: str = Field(max_length=180)
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    logging.warning(f"Rejected streamed request body over {self.max_bytes} bytes.")
+                    # Raised while FastAPI parses the body, which turns it into the 413 response
+                    raise too_large
+            return message
+        await self.app(scope, limited_receive, send)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(BodySizeLimit, max_bytes=MAX_BODY_BYTES)
+
+async def get_db(req: Request) -> DB:
+    return req.app.state.db
+
+async def get_mqtt(req: Request) -> mqtt.Client:
+    return req.app.state.mqtt
+
+# Response models: with a declared return type FastAPI serializes straight to
+# JSON bytes through pydantic-core instead of the stdlib json module (on recent
+# FastAPI releases, hence the floor in pyproject.toml)
+class PrintResponse(BaseModel):
+    status: str
+    message: str
+
+class CountResponse(BaseModel):
+    count: int
+
+def validate_image(img_data: bytes) -> bytes:
+    """
+    Checks that the uploaded image is a PNG of the expected dimensions.
+
+    Returns:
+        The PNG bytes, empty if the upload was empty.
+
+    Raises:
+        HTTPException: 400 if the image is malformed or has the wrong size.
+    """
+    if not img_data:
+        logging.info("No valid image data provided, proceeding without image.")
+        return b""
+
+    # --- Image Dimension Validation ---
+    # Read the dimensions straight from the PNG header instead of opening it with Pillow
+    if len(img_data) < 24 or img_data[:8] != PNG_SIGNATURE or img_data[12:16] != b"IHDR":
+        logging.warning("Received image data without a valid PNG header.")
+        raise HTTPException(status_code=400, detail="Invalid image format. Expected a PNG file.")
+    width, height = struct.unpack(">II", img_data[16:24])
+    # Check dimensions
+    if width != EXPECTED_WIDTH or height != EXPECTED_HEIGHT:
+        logging.warning(f"Received image with incorrect dimensions: {width}x{height}. Expected {EXPECTED_WIDTH}x{EXPECTED_HEIGHT}.")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image dimensions. Expected {EXPECTED_WIDTH}x{EXPECTED_HEIGHT}, but got {width}x{height}."
+        )
+    logging.info(f"Image dimensions validated: {width}x{height}")
+    return img_data
 
 @app.get("/")
-def index() -> FileResponse:
+async def index() -> Response:
     # not using StaticFiles to be extra-safe
-    return FileResponse("public/index.html")
+    return Response(INDEX_HTML, media_type="text/html")
 
 @app.get("/printer.png")
-def printer_png() -> FileResponse:
+async def printer_png() -> Response:
     # not using StaticFiles to be extra-safe
-    return FileResponse("public/printer.png")
+    return Response(PRINTER_PNG, media_type="image/png", headers=ASSET_HEADERS)
 
 @app.get("/WebPlus_HP_100LX_6x8.woff")
-def font_hp100() -> FileResponse:
+async def font_hp100() -> Response:
     # not using StaticFiles to be extra-safe
-    return FileResponse("public/WebPlus_HP_100LX_6x8.woff")
+    return Response(FONT_HP100, media_type="font/woff", headers=ASSET_HEADERS)
 
 # Add Request to the function signature
 @app.post("/print")
-async def print_message(print_req: PrintRequest, req: Request): # FastAPI validates length constraints from PrintRequest
+async def print_message(
+    req: Request,
+    # Message can be empty (FastAPI treats an empty form field as missing), limit length
+    msg: str = Form(default="", max_length=180),
+    # Allow None, but if present, limit length
+    title: Optional[str] = Form(default=None, max_length=40),
+    # Image is an optional raw PNG upload, so no base64 on either end
+    img: Optional[UploadFile] = File(default=None),
+    client: mqtt.Client = Depends(get_mqtt),
+) -> PrintResponse: # FastAPI validates the length constraints on the form fields
     try:
         # Get client IP address
         client_ip = req.client.host if req.client else "Unknown"
         logging.info(f"Received print request from IP: {client_ip}")
 
-        # --- Image Decoding ---
-        img_data = b"" # Default to empty bytes
-        if print_req.img and "," in print_req.img:
-            try:
-                header, encoded = print_req.img.split(",", 1)
-                # Basic check if it looks like a PNG data URL header
-                if header.startswith("data:image/png;base64"):
-                    img_data = base64.b64decode(encoded)
-                else:
-                    # If header is wrong, treat as bad request (invalid image format)
-                    logging.warning(f"Received image data URL with unexpected header: {header[:30]}...")
-                    raise HTTPException(status_code=400, detail="Invalid image format. Expected PNG data URL.")
-            except (ValueError, base64.binascii.Error) as decode_error:
-                logging.warning(f"Could not decode image base64 data: {decode_error}.")
-                raise HTTPException(status_code=400, detail="Invalid image base64 data.")
-        elif print_req.img is not None: # Handle case where img is present but not a valid data URL format
-             logging.warning("Received 'img' field but it was not a valid data URL format.")
-             # Treat as no image
-             img_data = None # Explicitly set to None if format is invalid
-
-        # --- Image Dimension Validation ---
-        if img_data: # Only validate if image data was successfully decoded
+        # --- Image Validation ---
+        img_data = b""
+        if img:
+            # BodySizeLimit already bounds the spooled upload; this enforces the tighter
+            # image limit without reading more than one byte past it into memory
+            img_data = await img.read(MAX_IMAGE_BYTES + 1)
+            if len(img_data) > MAX_IMAGE_BYTES:
+                logging.warning(f"Received image larger than {MAX_IMAGE_BYTES} bytes.")
+                raise HTTPException(status_code=413, detail=f"Image too large. Maximum size is {MAX_IMAGE_BYTES} bytes.")
+            img_data = validate_image(img_data)
+
+        # Same rule as the frontend: at least one field has content. Also catches
+        # requests without form fields, e.g. the JSON body an old page still sends
+        if not title and not msg and not img_data:
+            logging.warning(f"Received empty print request from IP: {client_ip}")
+            raise HTTPException(status_code=400, detail="Please provide a title, message, or image to print.")
+
+        # --- Image Rendering ---
+        # Dither and pack the image into ESC/POS raster commands here, so the
+        # single-threaded worker only has to write bytes to the printer
+        raw_escpos = None
+        if img_data:
             try:
-                image_stream = BytesIO(img_data)
-                with Image.open(image_stream) as img:
-                    # Check dimensions
-                    if img.width != EXPECTED_WIDTH or img.height != EXPECTED_HEIGHT:
-                        logging.warning(f"Received image with incorrect dimensions: {img.width}x{img.height}. Expected {EXPECTED_WIDTH}x{EXPECTED_HEIGHT}.")
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"Invalid image dimensions. Expected {EXPECTED_WIDTH}x{EXPECTED_HEIGHT}, but got {img.width}x{img.height}."
-                        )
-                    logging.info(f"Image dimensions validated: {img.width}x{img.height}")
-            except HTTPException:
-                 raise # Re-raise validation HTTPException
-            except Exception as img_err: # Catch PIL errors (invalid format etc.)
-                logging.warning(f"Failed to process image data: {img_err}", exc_info=True)
+                raw_escpos = await asyncio.to_thread(render_image, img_data)
+            except Exception as render_error: # Pillow errors (corrupted image data etc.)
+                logging.warning(f"Failed to render image data: {render_error}", exc_info=True)
                 raise HTTPException(status_code=400, detail="Invalid or corrupted image data.")
-        else:
-            # If img field in request was present but resulted in empty img_data (e.g., empty data URL or invalid format handled above),
-            # log that we are proceeding without an image.
-            logging.info("No valid image data provided or decoded, proceeding without image.")
-            img_data = None # Ensure img_data is None if no valid image
-
 
         # --- Prepare Message ---
         # Use provided title or a default if empty/None
-        # Pydantic handles the None default, use "Web Print" if title is None or ""
-        print_title = print_req.title if print_req.title else "No Title Message"
+        print_title = title if title else "No Title Message"
 
         # Create the message object (Data lengths already validated by FastAPI/Pydantic)
         # Add the client_ip here
-        msg = Message(
+        message = Message(
             title=print_title,
-            img=img_data, # Use the validated (or None) image data
-            msg=print_req.msg,
-            ip_address=client_ip # Add the IP address
+            img=img_data, # Use the validated (or empty) image data
+            msg=msg,
+            ip_address=client_ip, # Add the IP address
+            raw_escpos=raw_escpos,
         )
-        logging.info(f"Prepared message: title='{print_title}', msg='{print_req.msg[:50]}...', img_size={len(img_data) if img_data else 0} bytes, ip={client_ip}")
+        logging.info(f"Prepared message: title='{print_title}', msg='{msg[:50]}...', img_size={len(img_data)} bytes, ip={client_ip}")
 
         # --- Publish to MQTT ---
-        client.publish("printer", msg.model_dump_json(), qos=2)
-
+        payload = message.to_msgpack()
+        if not publish(client, payload):
+            raise HTTPException(status_code=503, detail="Could not queue message for printing.")
         logging.info("Published message to MQTT topic 'printer'")
-        return {"status": "success", "message": "Thanks for your message!"}
+        return PrintResponse(status="success", message="Thanks for your message!")
 
     except HTTPException:
          # Re-raise HTTP exceptions (like validation errors from FastAPI or our custom ones)
@@ -160,29 +296,33 @@ async def print_message(print_req: PrintRequest, req: Request): # FastAPI valida
 
 # --- New Endpoint for Message Count ---
 @app.get("/count")
-async def get_message_count():
+def get_message_count(db: DB = Depends(get_db)) -> CountResponse:
     """
     Returns the total number of messages stored in the database.
+    A plain def, so Starlette runs the blocking SQLite query in its threadpool
+    (on that thread's read connection) instead of on the event loop.
     """
     try:
         count = db.count()
         logging.debug(f"Retrieved message count: {count}")
-        return {"count": count}
+        return CountResponse(count=count)
     except Exception as e:
         logging.error(f"Error retrieving message count from database: {e}", exc_info=True)
         # Return a 500 error if the database count fails
         raise HTTPException(status_code=500, detail="Could not retrieve message count.")
 # --------------------------------------
 
-# --- Graceful Shutdown ---
-# Consider adding lifespan events for cleaner DB closing if needed,
-# but __del__ in DB class provides some safety.
-# @app.on_event("shutdown")
-# def shutdown_event():
-#     logging.info("Shutting down server...")
-#     if db:
-#         db.close()
-#     client.loop_stop()
-#     logging.info("MQTT client loop stopped.")
-# -------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Printer Server: serves the guestbook and publishes messages to MQTT.")
+    parser.add_argument("--host", type=str, default="0.0.0.0",
+                        help="Address to bind the HTTP server to (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Port to bind the HTTP server to (default: 8000)")
+    args = parser.parse_args()
+
+    # uvloop and httptools are the fastest event loop and HTTP parser uvicorn supports;
+    # the access log is off since every request is already logged by the handlers
+    uvicorn.run(app, host=args.host, port=args.port, loop="uvloop", http="httptools", access_log=False)
 
+if __name__ == "__main__":
+    main()
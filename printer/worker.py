@@ -1,27 +1,40 @@
 import io
+import queue
 import logging
 import argparse
+import threading
 from typing import Optional # Import Optional
 from escpos.printer import Usb
 from printer.model import Message
-from printer.db import DB  # Import the DB class
+from printer.db import DB, DuplicateMessage  # Import the DB class
+from printer.render import PROFILE
 import paho.mqtt.client as mqtt
 
 VENDOR_ID = 0x6868
 PRODUCT_ID = 0x0200
 IN_EP = 0x81
 OUT_EP = 0x03
-PROFILE = "NT-5890K"
+
+# Blank lines, separator and blank lines closing every message. Plain ASCII is
+# the same in every code page, so it is sent as raw bytes instead of text()
+FOOTER_RAW = b"\n" * 2 + b"-" * 30 + b"\n" * 2
 
 # Removed global variables:
 # dry_run = False
 # db_instance = None
 
+def open_printer() -> Usb:
+    """
+    Creates the USB printer handle. python-escpos claims the device lazily
+    whenever its device is False (initially, and after send_to_printer() resets
+    it on an error), so one handle serves every message.
+    """
+    return Usb(VENDOR_ID, PRODUCT_ID, in_ep=IN_EP, out_ep=OUT_EP, profile=PROFILE)
+
 # Modify function signature to accept message_id
-def send_to_printer(msg: Message, message_id: Optional[int]):
+def send_to_printer(printer: Usb, msg: Message, message_id: Optional[int]):
     """Sends the formatted message to the USB thermal printer."""
     try:
-        printer = Usb(VENDOR_ID, PRODUCT_ID, in_ep=IN_EP, out_ep=OUT_EP, profile=PROFILE)
         printer.ln()
         printer.set(bold=True, align="center")
 
@@ -36,28 +49,33 @@ def send_to_printer(msg: Message, message_id: Optional[int]):
         printer.text(print_title) # Use the constructed title
         printer.ln()
 
-        # Ensure msg.img is bytes if not None before creating BytesIO
-        img_bytes = msg.img if isinstance(msg.img, bytes) else None
-
-        if img_bytes is not None:
+        if msg.raw_escpos:
+            printer.ln(2)
+            # Already rendered by the server, send as-is
+            printer._raw(msg.raw_escpos)
+        elif msg.img:
             printer.ln(2)
-            # Use the bytes directly with BytesIO
-            printer.image(io.BytesIO(img_bytes), center=True)
+            printer.image(io.BytesIO(msg.img), center=True)
 
         if msg.msg and msg.msg.strip() != "": # Check if msg exists and is not just whitespace
             printer.ln(2)
             printer.set(bold=False, align="left")
             printer.text(msg.msg_ascii)
 
-        printer.ln(2)
-        printer.text("-" * 30)
-        printer.ln(2)
+        printer._raw(FOOTER_RAW)
         printer.buzzer()
         #printer.cut()
-        printer.close()
         logging.info(f"Successfully sent message ID {message_id if message_id else '(unknown)'} ('{msg.title}') to printer.")
     except Exception as e:
         logging.error(f"Failed to print message ID {message_id if message_id else '(unknown)'} ('{msg.title}'): {e}", exc_info=True)
+        # Drop the (possibly stale) USB claim; it is re-established on the next message
+        try:
+            printer.close()
+        except Exception as close_error:
+            logging.warning(f"Failed to release USB printer: {close_error}")
+        # A failed open() leaves device as None, which escpos never reopens and
+        # close() skips; False makes the next message claim the device again
+        printer.device = False
 
 
 def on_connect(client, userdata, flags, rc, props):
@@ -69,38 +87,64 @@ def on_connect(client, userdata, flags, rc, props):
         logging.fatal(f"Failed to connect to MQTT broker, return code: {rc}")
         import sys; sys.exit(1)
 
+def print_loop(print_q: queue.Queue, printer: Optional[Usb]):
+    """
+    Prints queued (message, insert_id) pairs one at a time, in the order the
+    database committed them. A None item stops the loop.
+    Without a printer (dry run) messages are only logged.
+    """
+    while (job := print_q.get()) is not None:
+        msg, insert_id = job
+        try:
+            if insert_id is not None:
+                logging.success(f"Message '{msg.title}' saved to database with ID: {insert_id}")
+
+            # --- Send to Printer ---
+            logging.info(f"Attempting to print message: '{msg.title}' (ID: {insert_id if insert_id else 'N/A'})")
+            if printer is not None:
+                # Pass the insert_id (which might be None) to the printer function
+                send_to_printer(printer, msg, insert_id)
+            else:
+                # Construct the potential title for logging even in dry run
+                dry_run_title = f"#{insert_id}. {msg.title_ascii}" if insert_id is not None else msg.title_ascii
+                logging.info(f"DRY RUN: Printer function would be called for message '{dry_run_title}'.")
+        except Exception as e:
+            logging.error(f"Error printing message '{msg.title}': {e}", exc_info=True)
+
 def on_message(client, userdata, raw_msg):
-    # Access db_instance and dry_run from userdata dictionary
+    # Access db_instance and the print queue from userdata dictionary
     db_instance = userdata.get('db')
-    dry_run = userdata.get('dry_run', False) # Default to False if not found
-    insert_id: Optional[int] = None # Initialize insert_id to None
+    print_q = userdata['print_q']
 
     try:
-        msg = Message.model_validate_json(raw_msg.payload)
+        try:
+            msg = Message.from_msgpack(raw_msg.payload)
+        except ValueError as e:
+            # Never let a malformed payload reach the DB writer or the printer
+            logging.error(f"Rejected malformed MQTT message: {type(e).__name__}: {e}")
+            return
         logging.info(f"Received message via MQTT: '{msg.title}' from IP: {msg.ip_address}")
 
         # --- Save to Database ---
         if db_instance:
-            logging.info(f"Attempting to save message '{msg.title}' to database...")
-            # Capture the returned ID
-            insert_id = db_instance.insert(msg)
-            if insert_id is not None:
-                logging.success(f"Message '{msg.title}' saved to database with ID: {insert_id}")
-            else:
-                # Log error, but continue to print attempt
-                logging.error(f"Failed to save message '{msg.title}' to database. ID will not be printed.")
+            logging.info(f"Queueing message '{msg.title}' for the database...")
+            # Don't block the MQTT loop on the commit: the DB writer batches
+            # inserts, and the message is printed once its ID is known
+            def on_saved(future, msg=msg):
+                try:
+                    insert_id = future.result()
+                except DuplicateMessage:
+                    # Redelivered by the broker and already handled, don't print it twice
+                    logging.warning(f"Message '{msg.title}' was already received, skipping print.")
+                    return
+                if insert_id is None:
+                    # Log error, but continue to print attempt
+                    logging.error(f"Failed to save message '{msg.title}' to database. ID will not be printed.")
+                print_q.put((msg, insert_id))
+            db_instance.enqueue_insert(msg).add_done_callback(on_saved)
         else:
             logging.warning("DB instance not available in userdata, skipping database save.")
-
-        # --- Send to Printer ---
-        logging.info(f"Attempting to print message: '{msg.title}' (ID: {insert_id if insert_id else 'N/A'})")
-        if not dry_run:
-            # Pass the insert_id (which might be None) to the printer function
-            send_to_printer(msg, insert_id)
-        else:
-            # Construct the potential title for logging even in dry run
-            dry_run_title = f"#{insert_id}. {msg.title_ascii}" if insert_id is not None else msg.title_ascii
-            logging.info(f"DRY RUN: Printer function would be called for message '{dry_run_title}'.")
+            print_q.put((msg, None))
 
     except Exception as e:
         # Catch errors during message validation or processing
@@ -146,8 +190,16 @@ def main():
     client.on_connect = on_connect
     client.on_message = on_message
 
-    # Set userdata to carry db_instance and dry_run status
-    user_data = {'db': db_instance, 'dry_run': args.dry}
+    # --- Start Printer Thread ---
+    # Printing is slow; keeping it off the MQTT loop lets messages keep flowing into the DB
+    print_q = queue.Queue()
+    # A single USB handle is reused for every message instead of re-claiming the device each time
+    printer = None if args.dry else open_printer()
+    printer_thread = threading.Thread(target=print_loop, args=(print_q, printer), name="printer", daemon=True)
+    printer_thread.start()
+
+    # Set userdata to carry db_instance and the print queue
+    user_data = {'db': db_instance, 'print_q': print_q}
     client.user_data_set(user_data)
 
     try:
@@ -157,9 +209,15 @@ def main():
         logging.fatal(f"Failed to connect or run MQTT client loop: {e}", exc_info=True)
     finally:
         logging.info("Shutting down Printer Worker...")
-        # Close DB connection if it was successfully created
+        # Close DB connection if it was successfully created; this commits
+        # pending inserts, which queues their prints
         if db_instance:
             db_instance.close()
+        # Let the printer finish whatever is queued
+        print_q.put(None)
+        printer_thread.join()
+        if printer:
+            printer.close()
         # Stop MQTT client
         client.loop_stop() # Stop the network loop if loop_forever was interrupted
         client.disconnect()